@@ -3,17 +3,25 @@
 
 """
 数据集加载示例
-从Hugging Face加载数据集并保存到本地
+从Hugging Face以流式方式加载数据集，并按大小分片保存到本地
 """
 
 import os
+import glob
 import argparse
 import traceback
-import json
+import mmap
+from typing import Any, List
+
+import orjson
 from datasets import load_dataset
 
 # 定义本地数据集保存路径
 LOCAL_DATASET_PATH = "local_datasets"
+# 分片文件名模板及默认分片大小（MB）
+SHARD_NAME_TEMPLATE = "part-{:05d}.jsonl"
+SHARD_GLOB = "part-*.jsonl"
+DEFAULT_SHARD_SIZE_MB = 512
 
 def parse_arguments() -> argparse.Namespace:
     """解析命令行参数"""
@@ -24,6 +32,8 @@ def parse_arguments() -> argparse.Namespace:
                        help='输出目录路径，默认为 local_datasets')
     parser.add_argument('--trust_remote_code', action='store_true',
                        help='允许执行数据集的自定义代码（对某些数据集必需）')
+    parser.add_argument('--shard_size_mb', type=int, default=DEFAULT_SHARD_SIZE_MB,
+                       help=f'单个分片文件的大小上限（MB），默认为 {DEFAULT_SHARD_SIZE_MB}')
     return parser.parse_args()
 
 def log_error_with_traceback(error_msg: str, e: Exception) -> None:
@@ -34,16 +44,46 @@ def log_error_with_traceback(error_msg: str, e: Exception) -> None:
     print("错误堆栈:")
     print(traceback.format_exc())
 
+def save_as_shards(ds: Any, shard_dir: str, shard_size: int) -> List[str]:
+    """将流式数据集逐条写入jsonl分片，单个分片超过shard_size字节后轮转，返回分片路径列表"""
+    # 清理上次运行遗留的分片，避免下游按通配符读取到过期数据
+    for stale_file in glob.glob(os.path.join(shard_dir, SHARD_GLOB)):
+        os.remove(stale_file)
+    
+    shard_files: List[str] = []
+    num_records = 0
+    f = None
+    try:
+        for record in ds:
+            if f is None or f.tell() >= shard_size:
+                if f is not None:
+                    f.close()
+                    print(f"已写入分片: {shard_files[-1]}")
+                shard_files.append(os.path.join(shard_dir, SHARD_NAME_TEMPLATE.format(len(shard_files))))
+                f = open(shard_files[-1], 'wb')
+            f.write(orjson.dumps(record, option=orjson.OPT_SERIALIZE_NUMPY) + b"\n")
+            num_records += 1
+    finally:
+        if f is not None:
+            f.close()
+    if shard_files:
+        print(f"已写入分片: {shard_files[-1]}")
+    print(f"共写入 {num_records:,} 条数据，{len(shard_files)} 个分片")
+    return shard_files
+
 def show_first_n_lines(file_path: str, n: int = 5) -> None:
     """显示文件的前n行内容"""
     print(f"\n显示保存文件的前{n}条数据:")
     print("="*80)
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            for i, line in enumerate(f):
-                if i >= n:
+        # 以只读内存映射方式按字节读取，orjson直接解析bytes，省去文本解码层
+        with open(file_path, 'rb') as f, \
+             mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for i in range(n):
+                line = mm.readline()
+                if not line:
                     break
-                data = json.loads(line)
+                data = orjson.loads(line)
                 print(f"\n第{i+1}条数据:")
                 for key, value in data.items():
                     if isinstance(value, str) and len(value) > 100:
@@ -63,30 +103,28 @@ def main() -> None:
     os.makedirs(args.output_dir, exist_ok=True)
     
     try:
-        # 加载数据集
+        # 以流式方式加载训练集，数据边下载边写出，内存占用与数据集大小无关
         print(f"正在加载数据集: {args.dataset_name}")
         print(f"信任远程代码: {'是' if args.trust_remote_code else '否'}")
-        ds = load_dataset(args.dataset_name, trust_remote_code=args.trust_remote_code)
+        ds = load_dataset(args.dataset_name, split="train", streaming=True,
+                          trust_remote_code=args.trust_remote_code)
         
         # 打印数据集信息
         print("\n数据集信息:")
-        print("数据集分割:", ds.keys())
         print("数据集类型:", type(ds))
+        print(f"特征:", ds.features)
+        print(f"示例:", next(iter(ds), "空"))
         
-        for split in ds.keys():
-            print(f"\n{split} 分割信息:")
-            print(f"特征:", ds[split].features)
-            print(f"大小:", len(ds[split]))
-            print(f"示例:", ds[split][0] if len(ds[split]) > 0 else "空")
-        
-        # 保存训练集
-        output_file = os.path.join(args.output_dir, f"{args.dataset_name.split('/')[-1]}.json")
-        print(f"\n正在保存数据集到: {output_file}")
-        ds['train'].to_json(output_file, lines=True)
+        # 分片保存训练集
+        shard_dir = os.path.join(args.output_dir, args.dataset_name.split('/')[-1])
+        os.makedirs(shard_dir, exist_ok=True)
+        print(f"\n正在保存数据集到: {shard_dir}")
+        shard_files = save_as_shards(ds, shard_dir, args.shard_size_mb * 1024 * 1024)
         print("保存完成！")
         
-        # 显示保存文件的前5条数据
-        show_first_n_lines(output_file, 5)
+        # 显示第一个分片的前5条数据
+        if shard_files:
+            show_first_n_lines(shard_files[0], 5)
         
     except Exception as e:
         log_error_with_traceback("加载或保存数据集时发生错误", e)
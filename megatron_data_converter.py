@@ -4,23 +4,32 @@
 """
 Megatron数据转换工具
 将数据集转换为Megatron-LM训练所需的格式
+
+词表不超过65536时词元以uint16存储，否则以int32存储；
+数据类型记录在.idx文件中，Megatron读取时会自动识别，读取端无需改动
 """
 
 # 标准库导入
 import os
 import sys
+import glob
 import time
+import queue
 import random
 import logging
 import argparse
+import threading
+import traceback
 from pathlib import Path
-from typing import Optional, Tuple, Dict, Any
+from typing import Optional, Tuple, Dict, Any, Callable, List, Type
 
 # 第三方库导入
 import numpy as np
-import torch
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 from tqdm import tqdm
-from datasets import Dataset
+from datasets import Dataset, Features, Sequence, Value
 from transformers import AutoTokenizer
 import sentencepiece as spm
 
@@ -32,7 +41,17 @@ from megatron.core.datasets.indexed_dataset import IndexedDatasetBuilder
 # 配置常量
 DEFAULT_SEED = 42
 DEFAULT_DTYPE = np.int32
+INPUT_SHARD_GLOB = "part-*.jsonl"  # 输入为目录时读取的分片文件
+OUTPUT_FORMATS = ("megatron", "parquet")  # 支持的输出格式
+DEFAULT_OUTPUT_FORMAT = "megatron"
+PARQUET_ROW_GROUP_SIZE = 65536  # parquet每个行组的样本数
+PARQUET_MAX_ROW_GROUP_TOKENS = 1 << 30  # parquet每个行组的词元数上限，保证list偏移量不超过int32
 MAX_ERRORS = 100
+BATCH_SIZE = 1024  # 每批分词的文本数量
+DEFAULT_NUM_PROC = max(1, (os.cpu_count() or 1) // 2)  # 默认分词进程数
+PREFETCH_BATCHES = 4  # 预取队列最多缓存的批次数
+QUEUE_TIMEOUT = 0.1  # 队列读写的轮询间隔（秒）
+END_OF_QUEUE = object()  # 队列结束标记
 SHOW_TEXT_INTERVAL = 60  # 显示文本的间隔（秒）
 SHOW_PROGRESS_INTERVAL = 5  # 更新进度条的间隔（秒）
 TEXT_PREVIEW_LENGTH = 100  # 文本预览长度
@@ -49,19 +68,23 @@ def setup_random_seed(seed: int = DEFAULT_SEED) -> None:
     """设置随机种子以确保可重现性"""
     random.seed(seed)
     np.random.seed(seed)
-    torch.manual_seed(seed)
 
 def parse_arguments() -> argparse.Namespace:
     """解析命令行参数"""
     parser = argparse.ArgumentParser(description='将数据集转换为Megatron格式')
     parser.add_argument('-i', '--input_path', type=str, required=True,
-                       help='输入文件路径（必需）')
+                       help='输入路径（必需），可以是单个文件、包含part-*.jsonl分片的目录或通配符')
     parser.add_argument('-o', '--output_dir', type=str, required=True,
                        help='输出目录路径（必需）')
     parser.add_argument('-n', '--dataset_name', type=str,
                        help='数据集名称，如果不指定则使用输入文件名（不含后缀）')
     parser.add_argument('-m', '--model_name', type=str, required=True,
                        help='模型名称（必需），例如：AI-ModelScope/Llama-2-70b-hf')
+    parser.add_argument('-f', '--output_format', type=str, choices=OUTPUT_FORMATS,
+                       default=DEFAULT_OUTPUT_FORMAT,
+                       help='输出格式：megatron（.bin和.idx）或 parquet，默认为 megatron')
+    parser.add_argument('-p', '--num_proc', type=int, default=DEFAULT_NUM_PROC,
+                       help=f'加载和分词使用的进程数，默认为CPU核数的一半（{DEFAULT_NUM_PROC}）')
     return parser.parse_args()
 
 def get_file_paths(args: argparse.Namespace, current_dir: Path) -> Tuple[Path, Path]:
@@ -77,6 +100,14 @@ def get_file_paths(args: argparse.Namespace, current_dir: Path) -> Tuple[Path, P
     output_dir.mkdir(parents=True, exist_ok=True)
     return input_file, output_dir
 
+def resolve_input_files(input_path: Path) -> List[str]:
+    """将输入路径展开为文件列表：目录取其中的分片，通配符按模式匹配，否则视为单个文件"""
+    if input_path.is_dir():
+        return sorted(str(f) for f in input_path.glob(INPUT_SHARD_GLOB))
+    if glob.has_magic(str(input_path)):
+        return sorted(glob.glob(str(input_path)))
+    return [str(input_path)] if input_path.exists() else []
+
 def load_tokenizer(model_name: str) -> Any:
     """加载tokenizer并处理可能的错误"""
     logger.info(f"正在加载tokenizer: {model_name}")
@@ -105,76 +136,259 @@ def load_tokenizer(model_name: str) -> Any:
             logger.error(f"调试过程中发生错误: {str(debug_e)}")
         raise
 
-def process_dataset(text_dataset: Dataset, tokenizer: Any, output_dir: Path) -> Tuple[int, int]:
-    """处理数据集并转换为Megatron格式"""
+def put_until_stopped(q: queue.Queue, item: Any, stop_event: threading.Event) -> bool:
+    """向有界队列放入数据，收到停止信号时放弃并返回False"""
+    while not stop_event.is_set():
+        try:
+            q.put(item, timeout=QUEUE_TIMEOUT)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def read_token_batches(tokenized: Dataset, out_queue: queue.Queue,
+                       stop_event: threading.Event) -> None:
+    """生产者线程：按批次读取分词结果，直接以Arrow ListArray形式交给写入线程"""
+    try:
+        batches = tokenized.with_format("arrow").iter(batch_size=BATCH_SIZE)
+        for batch_index, batch in enumerate(batches):
+            batch_ids = batch.column("input_ids").combine_chunks()
+            if not put_until_stopped(out_queue, (batch_index * BATCH_SIZE, batch_ids), stop_event):
+                return
+    except Exception as e:
+        put_until_stopped(out_queue, e, stop_event)
+    finally:
+        put_until_stopped(out_queue, END_OF_QUEUE, stop_event)
+
+def tokenize_texts(tokenizer: Any, texts: List[str]) -> List[List[int]]:
+    """批量分词，只返回input_ids"""
+    return tokenizer(texts, add_special_tokens=True,
+                     return_attention_mask=False,
+                     return_token_type_ids=False)["input_ids"]
+
+def tokenize_batch(texts: List[Any], tokenizer: Any) -> Dict[str, list]:
+    """datasets.map的批处理函数，输入为text列：空文本记为空列表，分词失败记为None"""
+    input_ids: list = [[] for _ in texts]
+    # 先整体过滤无效文本；isspace不像strip那样复制字符串
+    valid = [j for j, text in enumerate(texts)
+             if isinstance(text, str) and text and not text.isspace()]
+    if not valid:
+        return {"input_ids": input_ids}
+    
+    # 正常情况下整批只分词一次；失败时才逐个样本重试，定位出错的样本
+    try:
+        encoded = tokenize_texts(tokenizer, [texts[j] for j in valid])
+    except Exception as e:
+        logger.warning(f"批量分词时发生错误，改为逐个样本分词: {str(e)}")
+        encoded = []
+        for j in valid:
+            try:
+                encoded.append(tokenize_texts(tokenizer, [texts[j]])[0])
+            except Exception as sample_e:
+                logger.warning(f"分词时发生错误，跳过该样本: {str(sample_e)}")
+                encoded.append(None)
+    
+    for j, token_ids in zip(valid, encoded):
+        input_ids[j] = token_ids
+    return {"input_ids": input_ids}
+
+def unpack_token_batch(batch_ids: pa.ListArray,
+                       dtype: Type[np.number]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """用Arrow计算内核拆解一批分词结果，返回(拼接后的全部词元, 每行长度, 分词失败的行号)"""
+    values = batch_ids.flatten().to_numpy(zero_copy_only=False)
+    lengths = pc.fill_null(pc.list_value_length(batch_ids), 0).to_numpy(zero_copy_only=False)
+    error_rows = np.flatnonzero(batch_ids.is_null().to_numpy(zero_copy_only=False))
+    return np.asarray(values, dtype=dtype), lengths, error_rows
+
+def write_megatron_tokens(builder: IndexedDatasetBuilder, values: np.ndarray,
+                          lengths: np.ndarray) -> None:
+    """将一批样本的词元一次写入.bin并批量登记长度，效果等同于逐个调用add_item"""
+    builder.data_file.write(values.data)
+    builder.sequence_lengths.extend(lengths.tolist())
+
+class ParquetTokenWriter:
+    """将词元序列写入parquet文件的input_ids列（list<整数>），按行组批量写出并使用LZ4压缩"""
+    
+    def __init__(self, out_path: str, dtype: Type[np.number] = DEFAULT_DTYPE,
+                 row_group_size: int = PARQUET_ROW_GROUP_SIZE) -> None:
+        self.value_type = pa.from_numpy_dtype(dtype)
+        self.schema = pa.schema([("input_ids", pa.list_(self.value_type))])
+        self.writer = pq.ParquetWriter(out_path, self.schema, compression="lz4", use_dictionary=False)
+        self.row_group_size = row_group_size
+        self.pending_values: List[np.ndarray] = []
+        self.pending_lengths: List[np.ndarray] = []
+        self.pending_rows = 0
+        self.pending_tokens = 0
+    
+    def write_tokens(self, values: np.ndarray, lengths: np.ndarray) -> None:
+        """缓冲一批样本，满一个行组（或list偏移量接近int32上限）时写出"""
+        self.pending_values.append(values)
+        self.pending_lengths.append(lengths)
+        self.pending_rows += lengths.size
+        self.pending_tokens += values.size
+        if (self.pending_rows >= self.row_group_size
+                or self.pending_tokens >= PARQUET_MAX_ROW_GROUP_TOKENS):
+            self.write_row_group()
+    
+    def write_row_group(self) -> None:
+        """将缓冲的样本拼接为一个ListArray并写出为一个行组"""
+        if not self.pending_rows:
+            return
+        offsets = np.zeros(self.pending_rows + 1, dtype=np.int32)
+        np.cumsum(np.concatenate(self.pending_lengths), out=offsets[1:])
+        values = pa.array(np.concatenate(self.pending_values), type=self.value_type)
+        column = pa.ListArray.from_arrays(pa.array(offsets), values)
+        self.writer.write_table(pa.Table.from_arrays([column], schema=self.schema),
+                                row_group_size=self.pending_rows)
+        self.pending_values = []
+        self.pending_lengths = []
+        self.pending_rows = 0
+        self.pending_tokens = 0
+    
+    def finalize(self) -> None:
+        """写出剩余样本并关闭文件"""
+        self.write_row_group()
+        self.writer.close()
+
+def select_token_dtype(tokenizer: Any) -> Type[np.number]:
+    """根据词表大小选择能容纳所有词元ID的最小数据类型"""
+    # len(tokenizer)包含额外添加的特殊词元，比vocab_size更可靠
+    if len(tokenizer) <= np.iinfo(np.uint16).max + 1:
+        return np.uint16
+    return DEFAULT_DTYPE
+
+def get_output_files(output_dir: Path, output_format: str) -> List[str]:
+    """获取指定输出格式对应的输出文件路径"""
+    if output_format == "parquet":
+        return [str(output_dir / "token_dataset.parquet")]
+    dataset_prefix = output_dir / "megatron_dataset"
+    return [str(dataset_prefix) + ".bin", str(dataset_prefix) + ".idx"]
+
+def process_dataset(dataset: Dataset, tokenizer: Any, output_dir: Path,
+                    dtype: Type[np.number] = DEFAULT_DTYPE,
+                    num_proc: int = 1,
+                    output_format: str = DEFAULT_OUTPUT_FORMAT) -> Tuple[int, int]:
+    """处理数据集并转换为Megatron格式（或parquet格式）"""
     total_tokens = 0
     error_count = 0
     last_show_text_time = 0
-    last_show_progress_time = 0
-    
-    # 创建输出文件
-    dataset_prefix = output_dir / "megatron_dataset"
-    bin_file = str(dataset_prefix) + ".bin"
-    idx_file = str(dataset_prefix) + ".idx"
     
+    # 第一阶段：多进程批量分词，结果按词元存储类型缓存
+    # input_columns使每批text列直接转换为字符串列表，不逐条构造样本字典，也不解码其他列
     try:
-        builder = IndexedDatasetBuilder(bin_file, dtype=DEFAULT_DTYPE)
-        logger.info(f"创建IndexedDatasetBuilder成功，使用数据类型: {DEFAULT_DTYPE.__name__}")
+        tokenized = dataset.map(
+            tokenize_batch,
+            fn_kwargs={"tokenizer": tokenizer},
+            input_columns="text",
+            batched=True,
+            batch_size=BATCH_SIZE,
+            num_proc=num_proc if num_proc > 1 else None,
+            remove_columns=dataset.column_names,
+            features=Features({"input_ids": Sequence(Value(np.dtype(dtype).name))}),
+            desc="分词"
+        )
     except Exception as e:
-        logger.error(f"创建IndexedDatasetBuilder时发生错误: {str(e)}")
+        logger.error(f"分词时发生错误: {str(e)}")
         return total_tokens, error_count
     
+    # 第二阶段：按顺序写入，IndexedDatasetBuilder只支持顺序追加
+    output_files = get_output_files(output_dir, output_format)
+    write_tokens: Callable[[np.ndarray, np.ndarray], None]
+    finalize: Callable[[], None]
+    
+    if output_format == "parquet":
+        try:
+            parquet_writer = ParquetTokenWriter(output_files[0], dtype=dtype)
+            logger.info(f"创建ParquetTokenWriter成功，使用数据类型: {dtype.__name__}")
+        except Exception as e:
+            logger.error(f"创建ParquetTokenWriter时发生错误: {str(e)}")
+            return total_tokens, error_count
+        write_tokens = parquet_writer.write_tokens
+        finalize = parquet_writer.finalize
+    else:
+        bin_file, idx_file = output_files
+        try:
+            builder = IndexedDatasetBuilder(bin_file, dtype=dtype)
+            logger.info(f"创建IndexedDatasetBuilder成功，使用数据类型: {dtype.__name__}")
+        except Exception as e:
+            logger.error(f"创建IndexedDatasetBuilder时发生错误: {str(e)}")
+            return total_tokens, error_count
+        
+        def write_tokens(values: np.ndarray, lengths: np.ndarray) -> None:
+            write_megatron_tokens(builder, values, lengths)
+        
+        def finalize() -> None:
+            builder.end_document()
+            builder.finalize(idx_file)
+    
+    # 分词结果在后台线程中预取，主线程只负责写入，二者通过有界队列衔接
+    stop_event = threading.Event()
+    ids_queue: queue.Queue = queue.Queue(maxsize=PREFETCH_BATCHES)
+    reader = threading.Thread(target=read_token_batches,
+                              args=(tokenized, ids_queue, stop_event), daemon=True)
+    reader.start()
+    
     # 使用tqdm进度条处理数据集
-    with tqdm(text_dataset, desc="处理样本", unit="样本", ncols=100, 
-              bar_format='{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}{postfix}]') as pbar:
-        for i, example in enumerate(pbar):
-            try:
-                if not isinstance(example["text"], str) or not example["text"].strip():
-                    pbar.write(f"跳过样本 {i}: 文本为空或不是字符串")
-                    continue
+    try:
+        # 进度条刷新由tqdm按mininterval自行节流
+        with tqdm(total=len(tokenized), desc="写入样本", unit="样本", ncols=100,
+                  mininterval=SHOW_PROGRESS_INTERVAL,
+                  bar_format='{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}{postfix}]') as pbar:
+            while True:
+                item = ids_queue.get()
+                if item is END_OF_QUEUE:
+                    break
+                if isinstance(item, Exception):
+                    pbar.write(f"读取分词结果时发生错误: {str(item)}")
+                    break
+                
+                # 整批词元的拼接、类型转换和长度统计都在Arrow/numpy内核中完成，不逐个样本循环
+                batch_start, batch_ids = item
+                values, lengths, error_rows = unpack_token_batch(batch_ids, dtype)
+                written_rows = np.flatnonzero(lengths)
                 
-                token_ids = tokenizer(example["text"], return_tensors="pt")["input_ids"][0]
-                if len(token_ids) == 0:
-                    pbar.write(f"跳过样本 {i}: 分词后长度为0")
-                    continue
+                # 出错和跳过的样本很少，只对它们逐个输出提示
+                for row in error_rows:
+                    pbar.write(f"处理样本 {batch_start + row} 时发生错误: 分词失败")
+                if written_rows.size + error_rows.size < len(batch_ids):
+                    skipped_rows = np.setdiff1d(np.flatnonzero(lengths == 0), error_rows)
+                    for row in skipped_rows:
+                        pbar.write(f"跳过样本 {batch_start + row}: 文本为空或分词后长度为0")
+                error_count += error_rows.size
                 
-                builder.add_item(token_ids)
-                total_tokens += len(token_ids)
+                write_tokens(values, lengths[written_rows])
+                total_tokens += values.size
                 
-                # 更新进度显示
-                current_time = time.time()
-                if current_time - last_show_progress_time >= SHOW_PROGRESS_INTERVAL:
-                    formatted_tokens = f"{total_tokens:,}"
-                    formatted_avg = f"{total_tokens//(i + 1):,}" if i > 0 else "0"
-                    pbar.set_postfix({
-                        "总词元": formatted_tokens,
-                        "错误": error_count,
-                        "平均": formatted_avg
-                    })
-                    last_show_progress_time = current_time
+                # 每个批次只更新一次进度和统计信息
+                batch_end = batch_start + len(batch_ids)
+                pbar.update(len(batch_ids))
+                pbar.set_postfix_str(f"总词元={total_tokens:,}, 错误={error_count}, 平均={total_tokens//batch_end:,}",
+                                     refresh=False)
                 
-                # 显示文本预览
-                if current_time - last_show_text_time >= SHOW_TEXT_INTERVAL:
-                    text_preview = (example["text"][:TEXT_PREVIEW_LENGTH] + "..."
-                                  if len(example["text"]) > TEXT_PREVIEW_LENGTH
-                                  else example["text"])
+                # 显示文本预览，原文按索引从数据集中随机读取
+                current_time = time.monotonic()
+                if written_rows.size and current_time - last_show_text_time >= SHOW_TEXT_INTERVAL:
+                    i = batch_start + int(written_rows[0])
+                    text = dataset[i]["text"]
+                    text_preview = (text[:TEXT_PREVIEW_LENGTH] + "..."
+                                  if len(text) > TEXT_PREVIEW_LENGTH
+                                  else text)
                     pbar.write("\n" + "="*80)
-                    pbar.write(f"正在处理文本 (样本 {i+1}/{len(text_dataset)}):")
+                    pbar.write(f"正在处理文本 (样本 {i+1}/{len(dataset)}):")
                     pbar.write(text_preview)
                     pbar.write("="*80 + "\n")
                     last_show_text_time = current_time
-                    
-            except Exception as e:
-                pbar.write(f"处理样本 {i} 时发生错误: {str(e)}")
-                error_count += 1
+                
                 if error_count > MAX_ERRORS:
                     pbar.write("错误数量过多，终止处理")
                     break
+    finally:
+        stop_event.set()
+        reader.join()
     
     # 完成数据集构建
     try:
-        builder.end_document()
-        builder.finalize(idx_file)
+        finalize()
         return total_tokens, error_count
     except Exception as e:
         logger.error(f"完成数据集构建时发生错误: {str(e)}")
@@ -192,15 +406,20 @@ def main() -> None:
         logger.info(f"输入文件: {input_file}")
         logger.info(f"输出目录: {output_dir}")
         logger.info(f"模型名称: {args.model_name}")
+        logger.info(f"输出格式: {args.output_format}")
+        logger.info(f"进程数: {args.num_proc}")
         
         # 检查输入文件
-        if not input_file.exists():
+        input_files = resolve_input_files(input_file)
+        if not input_files:
             logger.error(f"错误: 文件 '{input_file}' 不存在!")
             return
+        logger.info(f"共找到 {len(input_files)} 个输入文件")
         
-        # 加载数据集
+        # 加载数据集，多个分片由多个进程并行解析
         try:
-            dataset = Dataset.from_json(str(input_file))
+            dataset = Dataset.from_json(input_files,
+                                        num_proc=args.num_proc if args.num_proc > 1 else None)
         except Exception as e:
             logger.error(f"加载数据集时发生错误: {str(e)}")
             return
@@ -209,9 +428,11 @@ def main() -> None:
             logger.error(f"错误: 数据集中没有'text'字段。可用字段: {list(dataset.features.keys())}")
             return
         
-        # 处理数据集
-        text_dataset = dataset.select_columns(["text"])
-        logger.info(f"数据集加载完成，共有{len(text_dataset)}条文本")
+        # 分词时只解码text列，无需先select_columns
+        logger.info(f"数据集加载完成，共有{len(dataset)}条文本")
+        
+        # 单进程时由Rust后端在批次内部并行；多进程时关闭，避免fork后死锁
+        os.environ["TOKENIZERS_PARALLELISM"] = "true" if args.num_proc <= 1 else "false"
         
         # 加载tokenizer
         try:
@@ -221,16 +442,20 @@ def main() -> None:
             return
         
         # 转换数据集
-        total_tokens, error_count = process_dataset(text_dataset, tokenizer, output_dir)
+        token_dtype = select_token_dtype(tokenizer)
+        logger.info(f"词表大小: {len(tokenizer):,}，词元存储类型: {token_dtype.__name__}")
+        total_tokens, error_count = process_dataset(dataset, tokenizer, output_dir,
+                                                    token_dtype, args.num_proc,
+                                                    args.output_format)
         
         # 显示最终结果
         logger.info("\n" + "="*80)
         logger.info("数据转换完成！")
-        logger.info(f"共处理了 {len(text_dataset)-error_count:,} 个样本")
+        logger.info(f"共处理了 {len(dataset)-error_count:,} 个样本")
         logger.info(f"总计 {total_tokens:,} 个词元")
-        logger.info(f"平均每个样本 {total_tokens//(len(text_dataset)-error_count):,} 个词元" 
-                   if (len(text_dataset)-error_count) > 0 else "平均每个样本 0 个词元")
-        logger.info(f"输出文件: {output_dir}/megatron_dataset.bin 和 {output_dir}/megatron_dataset.idx")
+        logger.info(f"平均每个样本 {total_tokens//(len(dataset)-error_count):,} 个词元" 
+                   if (len(dataset)-error_count) > 0 else "平均每个样本 0 个词元")
+        logger.info(f"输出文件: {' 和 '.join(get_output_files(output_dir, args.output_format))}")
         if error_count > 0:
             logger.warning(f"处理过程中跳过了 {error_count:,} 个有问题的样本")
         logger.info("="*80 + "\n")
@@ -10,11 +10,10 @@ Megatron数据集读取工具
 import os
 import sys
 import argparse
+import functools
 import traceback
 from pathlib import Path
-
-# 第三方库导入
-from transformers import AutoTokenizer
+from typing import Any, List, Optional, Tuple
 
 # 本地导入
 MEGATRON_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Megatron-LM")
@@ -31,16 +30,50 @@ def log_error_with_traceback(error_msg: str, e: Exception) -> None:
     print(traceback.format_exc())
     print("="*80 + "\n")
 
+def parse_index_range(value: str) -> Tuple[int, Optional[int]]:
+    """解析索引参数：单个索引N，或左闭右开的范围START:END，语义与Python切片相同"""
+    try:
+        if ':' not in value:
+            index = int(value)
+            return index, (index + 1) or None
+        start, end = value.split(':', 1)
+        return (int(start) if start else 0), (int(end) if end else None)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"无效的索引: {value}，应为 N 或 START:END")
+
 def parse_arguments() -> argparse.Namespace:
     """解析命令行参数"""
     parser = argparse.ArgumentParser(description='读取Megatron格式的数据集')
     parser.add_argument('-d', '--dataset_prefix', type=str, required=True,
                        help='数据集前缀路径（必需），例如：local_datasets/dataset_name/megatron_dataset')
-    parser.add_argument('-m', '--model_name', type=str, required=True,
-                       help='模型名称（必需），用于加载tokenizer')
-    parser.add_argument('-i', '--index', type=int, default=0,
-                       help='要读取的序列索引，默认为0')
-    return parser.parse_args()
+    parser.add_argument('-m', '--model_name', type=str,
+                       help='模型名称，用于加载tokenizer（解码时必需）')
+    parser.add_argument('-i', '--index', type=parse_index_range, default=(0, 1),
+                       help='要读取的序列索引N或索引范围START:END（不含END），默认为0')
+    parser.add_argument('--no_decode', action='store_true',
+                       help='只打印词元ID，不加载tokenizer解码')
+    args = parser.parse_args()
+    if not args.no_decode and not args.model_name:
+        parser.error("解码时必须通过 -m/--model_name 指定模型名称，或使用 --no_decode")
+    return args
+
+@functools.lru_cache(maxsize=None)
+def load_tokenizer(model_name: str) -> Any:
+    """加载fast（Rust实现）tokenizer，同一进程内按模型名缓存"""
+    # 延迟导入transformers，只打印词元ID时无需承担其导入开销
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(model_name, use_fast=True)
+
+def decode_sequences(tokenizer: Any, sequences: List[Any]) -> List[str]:
+    """批量解码多个序列；fast tokenizer直接调用Rust后端的decode_batch并行解码"""
+    token_lists = [sequence.tolist() for sequence in sequences]
+    if not tokenizer.is_fast:
+        return tokenizer.batch_decode(token_lists)
+    texts = tokenizer.backend_tokenizer.decode_batch(token_lists, skip_special_tokens=False)
+    # 与tokenizer.decode保持一致的空格清理
+    if getattr(tokenizer, "clean_up_tokenization_spaces", False):
+        texts = [tokenizer.clean_up_tokenization(text) for text in texts]
+    return texts
 
 def main():
     """主函数"""
@@ -56,30 +89,38 @@ def main():
             log_error_with_traceback("加载数据集时发生错误", e)
             return
             
+        start, end, _ = slice(*args.index).indices(len(dataset))
         try:
-            # 获取指定索引的序列
-            sequence = dataset[args.index]
-            print(f"\n序列内容 (索引 {args.index}):")
-            print(sequence)
+            # 获取指定范围的序列，连续范围通过切片一次读取
+            if start >= end:
+                raise IndexError(f"索引超出范围，数据集共有 {len(dataset)} 个序列")
+            sequences = dataset[start:end]
+            for index, sequence in enumerate(sequences, start=start):
+                print(f"\n序列内容 (索引 {index}):")
+                print(sequence)
         except Exception as e:
-            log_error_with_traceback(f"获取索引 {args.index} 的序列时发生错误", e)
+            log_error_with_traceback(f"获取索引 {start}:{end} 的序列时发生错误", e)
+            return
+        
+        if args.no_decode:
             return
             
         try:
             # 加载tokenizer并解码
             print(f"\n加载tokenizer: {args.model_name}")
-            tokenizer = AutoTokenizer.from_pretrained(args.model_name)
+            tokenizer = load_tokenizer(args.model_name)
         except Exception as e:
             log_error_with_traceback("加载tokenizer时发生错误", e)
             return
             
         try:
-            # 解码并打印文本
-            decoded_text = tokenizer.decode(sequence)
-            print("\n解码后的文本:")
-            print("="*80)
-            print(decoded_text)
-            print("="*80)
+            # 批量解码并打印文本
+            decoded_texts = decode_sequences(tokenizer, sequences)
+            for index, decoded_text in enumerate(decoded_texts, start=start):
+                print(f"\n解码后的文本 (索引 {index}):")
+                print("="*80)
+                print(decoded_text)
+                print("="*80)
         except Exception as e:
             log_error_with_traceback("解码序列时发生错误", e)
             return
@@ -1,31 +1,44 @@
+import pyarrow as pa
+import pyarrow.compute as pc
 import pyarrow.parquet as pq
-import pandas as pd
 
 # 读取 parquet 文件
 try:
-    # 读取单个 parquet 文件
-    df = pq.read_table('train-00000-of-00001.parquet').to_pandas()
-    # df = pq.read_table('train-00000-of-00002.parquet').to_pandas()
-    
+    # 打开单个 parquet 文件，只读取元数据，数据按需读取
+    pf = pq.ParquetFile('train-00000-of-00001.parquet')
+    # pf = pq.ParquetFile('train-00000-of-00002.parquet')
+    schema = pf.schema_arrow
+
     # 显示基本信息
-    print("数据集形状:", df.shape)
-    print("数据类型:\n", df.dtypes)
-    
-    # 查看 parquet 所有列名及前5行数据
-    print("\n列名:", df.columns.tolist())
+    print("数据集形状:", (pf.metadata.num_rows, len(schema.names)))
+    print("数据类型:\n", schema)
+
+    # 查看 parquet 所有列名及前5行数据，只解码第一个批次
+    print("\n列名:", schema.names)
     print("\n前5行数据预览:")
-    print(df.head())
-    
-    # 查看某一列前5行数据
+    head = next(pf.iter_batches(batch_size=5), None)
+    print(head.to_pydict() if head is not None else "空")
+
+    # 查看某一列前5行数据，列裁剪下推到文件读取
     print("\n'deepseek_grade_reason'列前5行数据:")
-    print(df['deepseek_grade_reason'].head())
-    
-    # 基本统计信息
+    column = next(pf.iter_batches(batch_size=5, columns=['deepseek_grade_reason']), None)
+    print(column.column(0).to_pylist() if column is not None else "空")
+
+    # 基本统计信息，只读取数值列
     print("\n数值列统计信息:")
-    print(df.describe())
-    
+    numeric_columns = [field.name for field in schema
+                       if pa.types.is_integer(field.type) or pa.types.is_floating(field.type)]
+    if numeric_columns:
+        table = pf.read(columns=numeric_columns, use_threads=True)
+        for name in numeric_columns:
+            values = table.column(name)
+            print(f"{name}: count={pc.count(values).as_py()}, "
+                  f"mean={pc.mean(values).as_py()}, std={pc.stddev(values).as_py()}, "
+                  f"min={pc.min(values).as_py()}, max={pc.max(values).as_py()}")
+    else:
+        print("没有数值列")
+
 except FileNotFoundError:
     print("文件不存在，请检查文件路径")
 except Exception as e:
     print(f"读取文件时出错: {e}")
-